@@ -5,35 +5,60 @@
 # Exposes an API for performing
 # parallel SSH operations
 #
-# Three commands are supplied:
+# The following commands are supplied:
 #
 # call(hosts, cmdline, opts)
 #
+# call_iter(hosts, cmdline, opts)
+#
+# call_batch(hosts, cmdlines, opts)
+#
+# run(hosts, cmdline, opts)
+#
 # copy(hosts, src, dst, opts)
 #
 # slurp(hosts, src, dst, opts)
 #
+# chain(hosts, steps, opts)
+#
+# close_connections(hosts, opts)
+#
 # call returns {host: (rc, stdout, stdin) | error}
+# call_iter yields (host, (rc, stdout, stdin) | error)
+# call_batch returns {host: [(rc, stdout, stderr), ...] | error}
+# run returns {host: (rc, stdout, stdin) | error}
 # copy returns {host: path | error}
 # slurp returns {host: path | error}
+# chain returns {host: [result of each step run]}
+# close_connections returns {host: (rc, stdout, stderr) | error}
 #
 # error is an error object which has an error message (or more)
 #
 # opts is bascially command line options
 #
 # call: Executes the given command on a set of hosts, collecting the output
+# call_iter: Like call, but yields each result as soon as its host finishes
+# call_batch: Executes several commands over a single connection per host
+# run: Like call, but only ssh errors (exit status 255) are reported as error
 # copy: Copies files from the local machine to a set of remote hosts
 # slurp: Copies files from a set of remote hosts to local folders
+# chain: Runs a sequence of call/copy/slurp steps on each host
+# close_connections: Closes the shared ControlMaster connections to hosts
 
 import os
 import sys
 import socket
+import random
+import itertools
+from copy import copy as _shallow_copy
 
 DEFAULT_PARALLELISM = 32
 DEFAULT_TIMEOUT = 0  # "infinity" by default
+CONTROL_DIR = '~/.parallax'
 
 from parallax.manager import Manager, FatalError
 from parallax.task import Task
+from parallax import psshutil
 
 
 try:
@@ -81,7 +106,9 @@ class Options(object):
     Setting the inline or inline_stdout options prints the
     output to stdout unless an alternative manager callback
     has been set. inline is True by default. This is a change
-    from pssh to parallax.
+    from pssh to parallax. With both set to False, output that is
+    not written to outdir/errdir or printed is read and discarded,
+    and is not kept in memory.
     """
     limit = DEFAULT_PARALLELISM  # Max number of parallel threads
     timeout = DEFAULT_TIMEOUT    # Timeout in seconds
@@ -94,6 +121,7 @@ class Options(object):
     verbose = False              # Warning and diagnostic messages
     quiet = False                # Silence extra output
     print_out = False            # Print output to stdout when received
+    stream_out = False           # Stream stdout to stdout line by line instead of storing it
     inline = True                # Store stdout and stderr in memory buffers
     inline_stdout = False        # Store stdout in memory buffer
     input_stream = None          # Stream to read stdin from
@@ -101,6 +129,94 @@ class Options(object):
     recursive = True             # (copy, slurp only) Copy recursively
     localdir = None              # (slurp only) Local base directory to copy to
     warn_message = True          # show warn message when asking for a password
+    multiplex = True             # Reuse SSH connections through a ControlMaster socket
+    control_persist = 60         # Seconds an idle master connection is kept open
+    control_dir = CONTROL_DIR    # Directory holding the ControlMaster sockets
+    reactor = 'epoll'            # Event loop used to wait for output: 'epoll', 'poll' or 'select'
+    connect_rate = 50            # Max number of new connections per second (0 for no limit)
+    connect_burst = None         # Connections that may start at once (defaults to connect_rate)
+
+    def __init__(self, **kwargs):
+        """
+        Options may be given as keyword arguments,
+        for example Options(limit=10, quiet=True).
+        """
+        # Each instance gets its own lists, so that appending to the
+        # options of one instance does not change them for all others.
+        self.ssh_options = []
+        self.ssh_extra = []
+        for name, value in kwargs.items():
+            if not hasattr(self, name):
+                raise TypeError("Unknown option: %s" % name)
+            setattr(self, name, value)
+
+
+def _control_master_options(opts):
+    """
+    SSH options enabling connection multiplexing, so that
+    repeated operations against a host open a new channel on
+    an existing master connection instead of doing a full
+    handshake every time.
+
+    The ControlPath is the expanded directory created by
+    _make_output_dirs, since ssh expands ~ from the passwd entry rather
+    than from $HOME. Where ssh supports it (OpenSSH 6.7 and later), %C
+    keeps the socket name short enough for the unix socket path limit
+    regardless of user and host name lengths.
+    """
+    if not opts.multiplex:
+        return []
+    control_dir = os.path.expanduser(opts.control_dir).replace('%', '%%')
+    version = psshutil.ssh_version()
+    if version is not None and version >= (6, 7):
+        name = 'cm-%C'
+    else:
+        name = 'cm-%r@%h:%p'
+    return ['-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=%s/%s' % (control_dir, name),
+            '-o', 'ControlPersist=%ss' % opts.control_persist]
+
+
+def _ssh_option_args(opts):
+    """
+    Returns the ['-o', option, ...] arguments for opts.ssh_options
+    followed by the multiplexing options.
+    """
+    args = list(itertools.chain.from_iterable(('-o', opt) for opt in opts.ssh_options))
+    args.extend(_control_master_options(opts))
+    return args
+
+
+def _make_output_dirs(opts):
+    """
+    Creates the stdout and stderr directories and the directory holding
+    the ControlMaster sockets, as needed. Multiplexing is only an
+    optimization, so if the control directory cannot be created, for
+    example because HOME is not writable, returns a copy of opts with
+    multiplex disabled. Otherwise returns opts.
+    """
+    if opts.outdir:
+        psshutil.makedirs(opts.outdir)
+    if opts.errdir:
+        psshutil.makedirs(opts.errdir)
+    if opts.multiplex:
+        try:
+            psshutil.makedirs(os.path.expanduser(opts.control_dir), 0o700)
+        except OSError:
+            opts = _shallow_copy(opts)
+            opts.multiplex = False
+    return opts
+
+
+# Expands host tuples shorter than (host, port, user), by length.
+_EXPAND_HOST_TUPLE = {
+    1: lambda v: (v[0], None, None),
+    2: lambda v: (v[0], v[1], None),
+}
+
+
+def _identity(v):
+    return v
 
 
 def _expand_host_port_user(lst):
@@ -108,15 +224,9 @@ def _expand_host_port_user(lst):
     Input: list containing hostnames, (host, port)-tuples or (host, port, user)-tuples.
     Output: list of (host, port, user)-tuples.
     """
-    def expand(v):
-        if isinstance(v, basestring):
-            return (v, None, None)
-        elif len(v) == 1:
-            return (v[0], None, None)
-        elif len(v) == 2:
-            return (v[0], v[1], None)
-        return v
-    return [expand(x) for x in lst]
+    expand = _EXPAND_HOST_TUPLE.get
+    return [(v, None, None) if isinstance(v, basestring) else expand(len(v), _identity)(v)
+            for v in lst]
 
 
 class _CallOutputBuilder(object):
@@ -127,61 +237,73 @@ class _CallOutputBuilder(object):
         """Called when Task is complete"""
         self.finished_tasks.append(task)
 
+    def task_result(self, task, manager):
+        """Returns the result for a single completed Task"""
+        if task.failures:
+            return Error(', '.join(task.failures), task)
+        return (task.exitstatus,
+                task.outputbuffer or manager.outdir,
+                task.errorbuffer or manager.errdir)
+
     def result(self, manager):
         """Called when all Tasks are complete to generate result"""
-        ret = {}
-        for task in self.finished_tasks:
-            if task.failures:
-                ret[task.host] = Error(', '.join(task.failures), task)
-            else:
-                ret[task.host] = (task.exitstatus,
-                                  task.outputbuffer or manager.outdir,
-                                  task.errorbuffer or manager.errdir)
-        return ret
-
-
-def _build_call_cmd(host, port, user, cmdline, opts):
-    cmd = ['ssh', host,
-           '-o', 'NumberOfPasswordPrompts=1',
-           '-o', 'SendEnv=PARALLAX_NODENUM PARALLAX_HOST']
-    if opts.ssh_options:
-        for opt in opts.ssh_options:
-            cmd += ['-o', opt]
-    if user:
-        cmd += ['-l', user]
-    if port:
-        cmd += ['-p', port]
-    if opts.ssh_key:
-        cmd += ['-i', opts.ssh_key]
-    if opts.ssh_extra:
-        cmd.extend(opts.ssh_extra)
-    if cmdline:
-        cmd.append(cmdline)
-    return cmd
+        return dict((task.host, self.task_result(task, manager))
+                    for task in self.finished_tasks)
 
 
-def call(hosts, cmdline, opts=Options()):
+def _call_cmd_builder(opts):
     """
-    Executes the given command on a set of hosts, collecting the output. Return Error when exit status != 0.
-    Returns {host: (rc, stdout, stdin) | Error}
+    Returns a function make_cmd(host, port, user, cmdline) returning
+    the ssh command line for a host. Everything that only depends on
+    opts is computed once, leaving only the per-host parts to be
+    added for each host.
     """
-    if opts.outdir and not os.path.exists(opts.outdir):
-        os.makedirs(opts.outdir)
-    if opts.errdir and not os.path.exists(opts.errdir):
-        os.makedirs(opts.errdir)
-    manager = Manager(limit=opts.limit,
-                      timeout=opts.timeout,
-                      askpass=opts.askpass,
-                      outdir=opts.outdir,
-                      errdir=opts.errdir,
-                      warn_message=opts.warn_message,
-                      callbacks=_CallOutputBuilder())
+    prefix = ['ssh', None,
+              '-o', 'NumberOfPasswordPrompts=1',
+              '-o', 'SendEnv=PARALLAX_NODENUM PARALLAX_HOST']
+    prefix.extend(_ssh_option_args(opts))
+    suffix = []
+    if opts.ssh_key:
+        suffix.extend(('-i', opts.ssh_key))
+    if opts.ssh_extra:
+        suffix.extend(opts.ssh_extra)
+
+    def make_cmd(host, port, user, cmdline):
+        cmd = prefix[:]
+        cmd[1] = host
+        if user:
+            cmd.extend(('-l', user))
+        if port:
+            cmd.extend(('-p', port))
+        cmd.extend(suffix)
+        if cmdline:
+            cmd.append(cmdline)
+        return cmd
+    return make_cmd
+
+
+def _make_manager(opts, callbacks):
+    return Manager(limit=opts.limit,
+                   timeout=opts.timeout,
+                   askpass=opts.askpass,
+                   outdir=opts.outdir,
+                   errdir=opts.errdir,
+                   warn_message=opts.warn_message,
+                   reactor=opts.reactor,
+                   connect_rate=opts.connect_rate,
+                   connect_burst=opts.connect_burst,
+                   callbacks=callbacks)
+
+
+def _add_call_tasks(manager, hosts, cmdline, opts):
+    """Adds a task running cmdline to manager for each host."""
+    make_cmd = _call_cmd_builder(opts)
     for host, port, user in _expand_host_port_user(hosts):
         is_local = is_local_host(host)
         if is_local:
             cmd = [cmdline]
         else:
-            cmd = _build_call_cmd(host, port, user, cmdline, opts)
+            cmd = make_cmd(host, port, user, cmdline)
         t = Task(host, port, user, cmd,
                  stdin=opts.input_stream,
                  verbose=opts.verbose,
@@ -189,53 +311,185 @@ def call(hosts, cmdline, opts=Options()):
                  print_out=opts.print_out,
                  inline=opts.inline,
                  inline_stdout=opts.inline_stdout,
+                 stream_out=opts.stream_out,
                  default_user=opts.default_user,
                  is_local=is_local)
         manager.add_task(t)
+
+
+def call(hosts, cmdline, opts=Options()):
+    """
+    Executes the given command on a set of hosts, collecting the output. Return Error when exit status != 0.
+    Returns {host: (rc, stdout, stdin) | Error}
+    """
+    opts = _make_output_dirs(opts)
+    manager = _make_manager(opts, _CallOutputBuilder())
+    _add_call_tasks(manager, hosts, cmdline, opts)
     try:
         return manager.run()
     except FatalError as err:
         raise IOError(str(err))
 
 
-class _CopyOutputBuilder(object):
-    def __init__(self):
-        self.finished_tasks = []
+def call_iter(hosts, cmdline, opts=Options()):
+    """
+    Executes the given command on a set of hosts like call, but yields
+    each result as soon as its host has finished. Stopping the iteration
+    early interrupts the hosts that have not finished yet.
+    Yields (host, (rc, stdout, stdin) | Error)
+    """
+    opts = _make_output_dirs(opts)
+    builder = _CallOutputBuilder()
+    manager = _make_manager(opts, builder)
+    _add_call_tasks(manager, hosts, cmdline, opts)
+    finished = manager.iter_finished()
+    try:
+        try:
+            for task in finished:
+                yield task.host, builder.task_result(task, manager)
+        except FatalError as err:
+            raise IOError(str(err))
+    finally:
+        finished.close()
+
+
+class _CallBatchOutputBuilder(_CallOutputBuilder):
+    def __init__(self, ncmds, separator):
+        super(_CallBatchOutputBuilder, self).__init__()
+        self.ncmds = ncmds
+        self.separator = separator.encode()
+
+    def _split(self, buf, has_rc):
+        """
+        Splits the output of a batch script at the separator lines
+        printed after each command. Returns a list of (rc, output)
+        pairs, rc being None when has_rc is false.
+        """
+        marker = b'\n' + self.separator + (b' ' if has_rc else b'\n')
+        parts = []
+        pos = 0
+        while True:
+            idx = buf.find(marker, pos)
+            if idx < 0:
+                break
+            out = buf[pos:idx]
+            pos = idx + len(marker)
+            rc = None
+            if has_rc:
+                eol = buf.find(b'\n', pos)
+                if eol < 0:
+                    break
+                rc = int(buf[pos:eol])
+                pos = eol + 1
+            parts.append((rc, out))
+        return parts
+
+    def task_result(self, task, manager):
+        """Returns the result for a single completed Task"""
+        if task.failures:
+            return Error(', '.join(task.failures), task)
+        outs = self._split(task.outputbuffer, True)
+        errs = self._split(task.errorbuffer, False)
+        if len(outs) != self.ncmds or len(errs) != self.ncmds:
+            return Error('Incomplete batch output', task)
+        return [(rc, out, err) for (rc, out), (_, err) in zip(outs, errs)]
+
+
+def _build_batch_script(cmdlines, separator):
+    """
+    Joins the commands into a single shell script. Each command
+    runs in a subshell with stdin from /dev/null, so that it can
+    neither exit the script nor consume the rest of it, and is
+    followed by a separator line on stdout (with the exit status)
+    and on stderr.
+    """
+    lines = []
+    for cmdline in cmdlines:
+        lines.append('(\n%s\n) </dev/null' % cmdline)
+        lines.append("printf '\\n%%s %%d\\n' %s $?" % separator)
+        lines.append("printf '\\n%%s\\n' %s >&2" % separator)
+    lines.append('')
+    return '\n'.join(lines).encode()
 
-    def finished(self, task, n):
-        self.finished_tasks.append(task)
 
-    def result(self, manager):
-        ret = {}
-        for task in self.finished_tasks:
-            if task.failures:
-                ret[task.host] = Error(', '.join(task.failures), task)
-            else:
-                ret[task.host] = (task.exitstatus,
-                                  task.outputbuffer or manager.outdir,
-                                  task.errorbuffer or manager.errdir)
-        return ret
-
-
-def _build_copy_cmd(host, port, user, src, dst, opts):
-    cmd = ['scp', '-qC']
-    if opts.ssh_options:
-        for opt in opts.ssh_options:
-            cmd += ['-o', opt]
-    if port:
-        cmd += ['-P', port]
+def call_batch(hosts, cmdlines, opts=Options()):
+    """
+    Executes a list of commands on a set of hosts using a single
+    connection per host, collecting the output of each command.
+    The commands are run by /bin/sh on the remote host.
+    Return Error when the connection fails.
+    Returns {host: [(rc, stdout, stderr), ...] | Error}
+    """
+    opts = _make_output_dirs(opts)
+    make_cmd = _call_cmd_builder(opts)
+    separator = '__PARALLAX_SEP_%016x__' % random.getrandbits(64)
+    script = _build_batch_script(cmdlines, separator)
+    builder = _CallBatchOutputBuilder(len(cmdlines), separator)
+    manager = _make_manager(opts, builder)
+    for host, port, user in _expand_host_port_user(hosts):
+        is_local = is_local_host(host)
+        if is_local:
+            cmd = ['sh -s']
+        else:
+            cmd = make_cmd(host, port, user, 'sh -s')
+        t = Task(host, port, user, cmd,
+                 stdin=script,
+                 verbose=opts.verbose,
+                 # The collected output is split on the separators, so it
+                 # must not be host-prefixed (quiet) or echoed (print_out).
+                 quiet=False,
+                 print_out=False,
+                 inline=True,
+                 inline_stdout=True,
+                 default_user=opts.default_user,
+                 is_local=is_local)
+        manager.add_task(t)
+    try:
+        return manager.run()
+    except FatalError as err:
+        raise IOError(str(err))
+
+
+class _CopyOutputBuilder(_CallOutputBuilder):
+    pass
+
+
+def _scp_args(opts):
+    """
+    Returns the scp arguments that go before and after
+    the per-host port option.
+    """
+    prefix = ['scp', '-qC']
+    prefix.extend(_ssh_option_args(opts))
+    suffix = []
     if opts.recursive:
-        cmd.append('-r')
+        suffix.append('-r')
     if opts.ssh_key:
-        cmd += ['-i', opts.ssh_key]
+        suffix.extend(('-i', opts.ssh_key))
     if opts.ssh_extra:
-        cmd.extend(opts.ssh_extra)
-    cmd.append(src)
-    if user:
-        cmd.append('%s@[%s]:%s' % (user, host, dst))
-    else:
-        cmd.append('[%s]:%s' % (host, dst))
-    return cmd
+        suffix.extend(opts.ssh_extra)
+    return prefix, suffix
+
+
+def _copy_cmd_builder(opts):
+    """
+    Returns a function make_cmd(host, port, user, src, dst) returning
+    the scp command line copying the local src to dst on a host.
+    """
+    prefix, suffix = _scp_args(opts)
+
+    def make_cmd(host, port, user, src, dst):
+        cmd = prefix[:]
+        if port:
+            cmd.extend(('-P', port))
+        cmd.extend(suffix)
+        cmd.append(src)
+        if user:
+            cmd.append('%s@[%s]:%s' % (user, host, dst))
+        else:
+            cmd.append('[%s]:%s' % (host, dst))
+        return cmd
+    return make_cmd
 
 
 def copy(hosts, src, dst, opts=Options()):
@@ -247,19 +501,11 @@ def copy(hosts, src, dst, opts=Options()):
     opts: CopyOptions (optional)
     Returns {host: (rc, stdout, stdin) | Error}
     """
-    if opts.outdir and not os.path.exists(opts.outdir):
-        os.makedirs(opts.outdir)
-    if opts.errdir and not os.path.exists(opts.errdir):
-        os.makedirs(opts.errdir)
-    manager = Manager(limit=opts.limit,
-                      timeout=opts.timeout,
-                      askpass=opts.askpass,
-                      outdir=opts.outdir,
-                      errdir=opts.errdir,
-                      warn_message=opts.warn_message,
-                      callbacks=_CopyOutputBuilder())
+    opts = _make_output_dirs(opts)
+    make_cmd = _copy_cmd_builder(opts)
+    manager = _make_manager(opts, _CopyOutputBuilder())
     for host, port, user in _expand_host_port_user(hosts):
-        cmd = _build_copy_cmd(host, port, user, src, dst, opts)
+        cmd = make_cmd(host, port, user, src, dst)
         t = Task(host, port, user, cmd,
                  stdin=opts.input_stream,
                  verbose=opts.verbose,
@@ -267,6 +513,7 @@ def copy(hosts, src, dst, opts=Options()):
                  print_out=opts.print_out,
                  inline=opts.inline,
                  inline_stdout=opts.inline_stdout,
+                 stream_out=opts.stream_out,
                  default_user=opts.default_user)
         manager.add_task(t)
     try:
@@ -275,62 +522,60 @@ def copy(hosts, src, dst, opts=Options()):
         raise IOError(str(err))
 
 
-class _SlurpOutputBuilder(object):
+class _SlurpOutputBuilder(_CallOutputBuilder):
     def __init__(self, localdirs):
-        self.finished_tasks = []
+        super(_SlurpOutputBuilder, self).__init__()
         self.localdirs = localdirs
 
-    def finished(self, task, n):
-        self.finished_tasks.append(task)
-
-    def result(self, manager):
-        ret = {}
-        for task in self.finished_tasks:
-            if task.failures:
-                ret[task.host] = Error(', '.join(task.failures), task)
-            else:
-                # TODO: save name of output file in Task
-                ret[task.host] = (task.exitstatus,
-                                  task.outputbuffer or manager.outdir,
-                                  task.errorbuffer or manager.errdir,
-                                  self.localdirs.get(task.host, None))
-        return ret
+    def task_result(self, task, manager):
+        if task.failures:
+            return Error(', '.join(task.failures), task)
+        # TODO: save name of output file in Task
+        return (task.exitstatus,
+                task.outputbuffer or manager.outdir,
+                task.errorbuffer or manager.errdir,
+                self.localdirs.get(task.host, None))
 
 
 def _slurp_make_local_dirs(hosts, dst, opts):
-    if opts.localdir and not os.path.exists(opts.localdir):
-        os.makedirs(opts.localdir)
+    """
+    Creates the local directory for each host.
+    hosts: [(host, port, user)...] as returned by _expand_host_port_user
+    """
+    if opts.localdir:
+        psshutil.makedirs(opts.localdir)
     localdirs = {}
-    for host, port, user in _expand_host_port_user(hosts):
+    dirnames = set()
+    for host, port, user in hosts:
         if opts.localdir:
             dirname = os.path.join(opts.localdir, host)
         else:
             dirname = host
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        dirnames.add(dirname)
         localdirs[host] = os.path.join(dirname, dst)
+    psshutil.makedirs_parallel(dirnames, min(opts.limit, 32))
     return localdirs
 
 
-def _build_slurp_cmd(host, port, user, src, dst, opts):
-    cmd = ['scp', '-qC']
-    if opts.ssh_options:
-        for opt in opts.ssh_options:
-            cmd += ['-o', opt]
-    if port:
-        cmd += ['-P', port]
-    if opts.recursive:
-        cmd.append('-r')
-    if opts.ssh_key:
-        cmd += ['-i', opts.ssh_key]
-    if opts.ssh_extra:
-        cmd.extend(opts.ssh_extra)
-    if user:
-        cmd.append('%s@[%s]:%s' % (user, host, src))
-    else:
-        cmd.append('[%s]:%s' % (host, src))
-    cmd.append(dst)
-    return cmd
+def _slurp_cmd_builder(opts):
+    """
+    Returns a function make_cmd(host, port, user, src, dst) returning
+    the scp command line copying src on a host to the local dst.
+    """
+    prefix, suffix = _scp_args(opts)
+
+    def make_cmd(host, port, user, src, dst):
+        cmd = prefix[:]
+        if port:
+            cmd.extend(('-P', port))
+        cmd.extend(suffix)
+        if user:
+            cmd.append('%s@[%s]:%s' % (user, host, src))
+        else:
+            cmd.append('[%s]:%s' % (host, src))
+        cmd.append(dst)
+        return cmd
+    return make_cmd
 
 
 def slurp(hosts, src, dst, opts=Options()):
@@ -344,21 +589,14 @@ def slurp(hosts, src, dst, opts=Options()):
     """
     if os.path.isabs(dst):
         raise ValueError("slurp: Destination must be a relative path")
+    hosts = _expand_host_port_user(hosts)
     localdirs = _slurp_make_local_dirs(hosts, dst, opts)
-    if opts.outdir and not os.path.exists(opts.outdir):
-        os.makedirs(opts.outdir)
-    if opts.errdir and not os.path.exists(opts.errdir):
-        os.makedirs(opts.errdir)
-    manager = Manager(limit=opts.limit,
-                      timeout=opts.timeout,
-                      askpass=opts.askpass,
-                      outdir=opts.outdir,
-                      errdir=opts.errdir,
-                      warn_message=opts.warn_message,
-                      callbacks=_SlurpOutputBuilder(localdirs))
-    for host, port, user in _expand_host_port_user(hosts):
+    opts = _make_output_dirs(opts)
+    make_cmd = _slurp_cmd_builder(opts)
+    manager = _make_manager(opts, _SlurpOutputBuilder(localdirs))
+    for host, port, user in hosts:
         localpath = localdirs[host]
-        cmd = _build_slurp_cmd(host, port, user, src, localpath, opts)
+        cmd = make_cmd(host, port, user, src, localpath)
         t = Task(host, port, user, cmd,
                  stdin=opts.input_stream,
                  verbose=opts.verbose,
@@ -366,6 +604,7 @@ def slurp(hosts, src, dst, opts=Options()):
                  print_out=opts.print_out,
                  inline=opts.inline,
                  inline_stdout=opts.inline_stdout,
+                 stream_out=opts.stream_out,
                  default_user=opts.default_user)
         manager.add_task(t)
     try:
@@ -374,71 +613,193 @@ def slurp(hosts, src, dst, opts=Options()):
         raise IOError(str(err))
 
 
-def is_local_host(host):
+class _ChainOutputBuilder(_CallOutputBuilder):
+    def __init__(self, steps):
+        super(_ChainOutputBuilder, self).__init__()
+        self.steps = steps
+        self.positions = {}
+        self.results = {}
+
+    def start(self, manager, index, host, port, user):
+        """Adds the Task for the given step on a host to the manager"""
+        make_task = self.steps[index][0]
+        task = make_task(host, port, user)
+        self.positions[task] = (index, host, port, user)
+        manager.add_task(task)
+
+    def finished(self, task, n):
+        """Steps are advanced by step_finished as chain() iterates"""
+        pass
+
+    def step_finished(self, task, manager):
+        """Records the step result and starts the next step on success"""
+        index, host, port, user = self.positions.pop(task)
+        task_result = self.steps[index][1]
+        result = task_result(task, manager)
+        self.results.setdefault(task.host, []).append(result)
+        if not isinstance(result, Error) and index + 1 < len(self.steps):
+            self.start(manager, index + 1, host, port, user)
+
+    def result(self, manager):
+        return self.results
+
+
+def _chain_step(step, hosts, opts):
     """
-    Check if the host is local
+    Returns (make_task(host, port, user), task_result(task, manager))
+    for a chain step.
+    """
+    kind, args = step[0], step[1:]
+    if kind == 'call':
+        cmdline, = args
+        make_cmd = _call_cmd_builder(opts)
+        builder = _CallOutputBuilder()
+    elif kind == 'copy':
+        src, dst = args
+        make_cmd = _copy_cmd_builder(opts)
+        builder = _CopyOutputBuilder()
+    elif kind == 'slurp':
+        src, dst = args
+        if os.path.isabs(dst):
+            raise ValueError("slurp: Destination must be a relative path")
+        localdirs = _slurp_make_local_dirs(hosts, dst, opts)
+        make_cmd = _slurp_cmd_builder(opts)
+        builder = _SlurpOutputBuilder(localdirs)
+    else:
+        raise ValueError("chain: Unknown step: %s" % (kind,))
+
+    def make_task(host, port, user):
+        is_local = False
+        if kind == 'call':
+            is_local = is_local_host(host)
+            if is_local:
+                cmd = [cmdline]
+            else:
+                cmd = make_cmd(host, port, user, cmdline)
+        elif kind == 'copy':
+            cmd = make_cmd(host, port, user, src, dst)
+        else:
+            cmd = make_cmd(host, port, user, src, localdirs[host])
+        return Task(host, port, user, cmd,
+                    stdin=opts.input_stream,
+                    verbose=opts.verbose,
+                    quiet=opts.quiet,
+                    print_out=opts.print_out,
+                    inline=opts.inline,
+                    inline_stdout=opts.inline_stdout,
+                    stream_out=opts.stream_out,
+                    default_user=opts.default_user,
+                    is_local=is_local)
+    return make_task, builder.task_result
+
+
+def chain(hosts, steps, opts=Options()):
+    """
+    Runs a sequence of steps on a set of hosts. Each host starts its next
+    step as soon as its previous one has succeeded, without waiting for
+    the other hosts. A failed step ends the sequence for that host.
+    steps: [('call', cmdline) | ('copy', src, dst) | ('slurp', src, dst)...]
+    Returns {host: [result of each step run]}, each result as returned
+    by call, copy or slurp.
+    """
+    hosts = _expand_host_port_user(hosts)
+    opts = _make_output_dirs(opts)
+    builder = _ChainOutputBuilder([_chain_step(step, hosts, opts)
+                                   for step in steps])
+    manager = _make_manager(opts, builder)
+    if steps:
+        for host, port, user in hosts:
+            builder.start(manager, 0, host, port, user)
+    try:
+        for task in manager.iter_finished():
+            builder.step_finished(task, manager)
+        return builder.result(manager)
+    except FatalError as err:
+        raise IOError(str(err))
+
+
+# Successful reverse DNS lookups done by is_local_host, by address.
+_reverse_names = {}
+_REVERSE_NAMES_MAX = 1024
+
+
+def _reverse_name(host):
+    """
+    Returns the name of host if it is an IP address that resolves,
+    otherwise host itself. Failed lookups are not cached, so that a
+    transient resolver error is retried on the next call.
     """
+    try:
+        return _reverse_names[host]
+    except KeyError:
+        pass
     try:
         socket.inet_aton(host)
         hostname = socket.gethostbyaddr(host)[0]
-    except:
-        hostname = host
-    return hostname == socket.gethostname()
+    except (socket.error, socket.herror):
+        return host
+    if len(_reverse_names) >= _REVERSE_NAMES_MAX:
+        _reverse_names.clear()
+    _reverse_names[host] = hostname
+    return hostname
+
+
+def is_local_host(host):
+    """
+    Check if the host is local
+    """
+    return _reverse_name(host) == socket.gethostname()
 
 def run(hosts, cmdline, opts=Options()):
     """
     Executes the given command on a set of hosts, collecting the output. Return Error when ssh error occurred.
     Returns {host: (rc, stdout, stdin) | Error}
     """
-    if opts.outdir and not os.path.exists(opts.outdir):
-        os.makedirs(opts.outdir)
-    if opts.errdir and not os.path.exists(opts.errdir):
-        os.makedirs(opts.errdir)
+    opts = _make_output_dirs(opts)
+    manager = _make_manager(opts, _RunOutputBuilder())
+    _add_call_tasks(manager, hosts, cmdline, opts)
+    try:
+        return manager.run()
+    except FatalError as err:
+        raise IOError(str(err))
+
+
+class _RunOutputBuilder(_CallOutputBuilder):
+    def task_result(self, task, manager):
+        """Returns the result for a single completed Task"""
+        if task.exitstatus == 255:
+            return Error(', '.join(task.failures), task)
+        return (task.exitstatus,
+                task.outputbuffer or manager.outdir,
+                task.errorbuffer or manager.errdir)
+
+
+def close_connections(hosts, opts=Options()):
+    """
+    Closes the ControlMaster connections to the given hosts, rather
+    than leaving them open for opts.control_persist seconds. Hosts
+    without an open master connection are reported as Error.
+    Returns {host: (rc, stdout, stderr) | Error}
+    """
+    if not opts.multiplex:
+        return {}
+    make_cmd = _call_cmd_builder(opts)
     manager = Manager(limit=opts.limit,
                       timeout=opts.timeout,
-                      askpass=opts.askpass,
-                      outdir=opts.outdir,
-                      errdir=opts.errdir,
-                      warn_message=opts.warn_message,
-                      callbacks=_RunOutputBuilder())
+                      reactor=opts.reactor,
+                      callbacks=_CallOutputBuilder())
     for host, port, user in _expand_host_port_user(hosts):
-        is_local = is_local_host(host)
-        if is_local:
-            cmd = [cmdline]
-        else:
-            cmd = _build_call_cmd(host, port, user, cmdline, opts)
+        if is_local_host(host):
+            continue
+        cmd = make_cmd(host, port, user, None)
+        cmd[1:1] = ['-O', 'exit']
         t = Task(host, port, user, cmd,
-                 stdin=opts.input_stream,
                  verbose=opts.verbose,
-                 quiet=opts.quiet,
-                 print_out=opts.print_out,
-                 inline=opts.inline,
-                 inline_stdout=opts.inline_stdout,
-                 default_user=opts.default_user,
-                 is_local=is_local)
+                 quiet=True,
+                 inline=True,
+                 default_user=opts.default_user)
         manager.add_task(t)
     try:
         return manager.run()
     except FatalError as err:
         raise IOError(str(err))
-
-
-class _RunOutputBuilder(object):
-    def __init__(self):
-        self.finished_tasks = []
-
-    def finished(self, task, n):
-        """Called when Task is complete"""
-        self.finished_tasks.append(task)
-
-    def result(self, manager):
-        """Called when all Tasks are complete to generate result"""
-        ret = {}
-        for task in self.finished_tasks:
-            if task.exitstatus == 255:
-                ret[task.host] = Error(', '.join(task.failures), task)
-            else:
-                ret[task.host] = (task.exitstatus,
-                                  task.outputbuffer or manager.outdir,
-                                  task.errorbuffer or manager.errdir)
-        return ret
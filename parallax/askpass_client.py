@@ -37,11 +37,17 @@ _executable_path = None
 def executable_path():
     """Determines the value to use for SSH_ASKPASS.
 
+    The PARALLAX_ASKPASS_PATH environment variable can be set to the
+    location of parallax-askpass to skip searching ASKPASS_PATHS.
     The value is cached since this may be called many times.
     """
     global _executable_path
     if _executable_path is None:
-        for path in ASKPASS_PATHS:
+        paths = ASKPASS_PATHS
+        override = os.getenv('PARALLAX_ASKPASS_PATH')
+        if override:
+            paths = (override,) + paths
+        for path in paths:
             if os.access(path, os.X_OK):
                 _executable_path = path
                 break
@@ -93,13 +99,23 @@ def askpass_main():
         sys.stderr.write("Couldn't bind to %s: %s.\n" % (address, message))
         sys.exit(2)
 
+    chunks = []
     try:
-        password = sock.makefile().read()
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
     except socket.error:
         sys.stderr.write("Socket error.\n")
         sys.exit(3)
 
-    print(password)
+    password = b''.join(chunks) + b'\n'
+    try:
+        sys.stdout.buffer.write(password)
+    except AttributeError:
+        sys.stdout.write(password)
+    sys.stdout.flush()
 
 
 if __name__ == '__main__':
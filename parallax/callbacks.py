@@ -6,6 +6,14 @@ import time
 
 from parallax import color
 
+# The status labels never change, so they are only formatted once.
+_SUCCESS = "[SUCCESS]"
+_FAILURE = "[FAILURE]"
+_STDERR = "Stderr: "
+_SUCCESS_COLORED = color.g("[%s]" % color.B("SUCCESS"))
+_FAILURE_COLORED = color.r("[%s]" % color.B("FAILURE"))
+_STDERR_COLORED = color.r(_STDERR)
+
 
 class DefaultCallbacks(object):
     """
@@ -17,18 +25,19 @@ class DefaultCallbacks(object):
         n: Index in sequence of completed tasks.
         """
         error = ', '.join(task.failures)
-        tstamp = time.asctime().split()[3]  # Current time
+        tstamp = time.strftime('%H:%M:%S')  # Current time
         if color.has_colors(sys.stdout):
             progress = color.c("[%s]" % color.B(n))
-            success = color.g("[%s]" % color.B("SUCCESS"))
-            failure = color.r("[%s]" % color.B("FAILURE"))
-            stderr = color.r("Stderr: ")
-            error = color.r(color.B(error))
+            success = _SUCCESS_COLORED
+            failure = _FAILURE_COLORED
+            stderr = _STDERR_COLORED
+            if error:
+                error = color.r(color.B(error))
         else:
             progress = "[%s]" % n
-            success = "[SUCCESS]"
-            failure = "[FAILURE]"
-            stderr = "Stderr: "
+            success = _SUCCESS
+            failure = _FAILURE
+            stderr = _STDERR
         host = task.pretty_host
         if not task.quiet:
             if task.failures:
@@ -57,4 +66,5 @@ class DefaultCallbacks(object):
         """
         When all Tasks are completed, generate a result to return.
         """
-        return [task.exitstatus for task in manager.save_tasks if task in manager.done]
+        done = set(manager.done)
+        return [task.exitstatus for task in manager.save_tasks if task in done]
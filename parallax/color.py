@@ -1,6 +1,8 @@
 # Copyright (c) 2009-2012, Andrew McNabb
 # Copyright (c) 2003-2008, Brent N. Chun
 
+import os
+
 
 def with_color(string, fg, bg=49):
     '''Given foreground/background ANSI color codes, return a string that,
@@ -16,48 +18,85 @@ def B(string):
     return "\x1b[1m%s\x1b[22m" % string
 
 
+# Escape sequences for the color helpers below. Those only change the
+# foreground color, so resetting the background is not needed.
+_RED = "\x1b[31m"
+_GREEN = "\x1b[32m"
+_YELLOW = "\x1b[33m"
+_BLUE = "\x1b[34m"
+_MAGENTA = "\x1b[35m"
+_CYAN = "\x1b[36m"
+_WHITE = "\x1b[37m"
+_RESET = "\x1b[39m"
+
+
 def r(string):
     "Red"
-    return with_color(string, 31)
+    return _RED + string + _RESET
 
 
 def g(string):
     "Green"
-    return with_color(string, 32)
+    return _GREEN + string + _RESET
 
 
 def y(string):
     "Yellow"
-    return with_color(string, 33)
+    return _YELLOW + string + _RESET
 
 
 def b(string):
     "Blue"
-    return with_color(string, 34)
+    return _BLUE + string + _RESET
 
 
 def m(string):
     "Magenta"
-    return with_color(string, 35)
+    return _MAGENTA + string + _RESET
 
 
 def c(string):
     "Cyan"
-    return with_color(string, 36)
+    return _CYAN + string + _RESET
 
 
 def w(string):
     "White"
-    return with_color(string, 37)
+    return _WHITE + string + _RESET
+
+
+# Color support per file descriptor, see has_colors.
+_color_support = {}
 
 
-# following from Python cookbook, #475186
 def has_colors(stream):
     '''Returns boolean indicating whether or not the supplied stream supports
     ANSI color.
+
+    Setting PARALLAX_COLOR to 1 or 0 in the environment forces color on
+    or off, skipping the terminal check.
+
+    The result is cached per file descriptor, since the check reads the
+    terminfo database and is made for every completed task.
     '''
+    override = os.environ.get('PARALLAX_COLOR')
+    if override == '1':
+        return True
+    if override == '0':
+        return False
     if not hasattr(stream, "isatty"):
         return False
+    try:
+        fd = stream.fileno()
+    except (AttributeError, ValueError, IOError):
+        return _detect_colors(stream)
+    if fd not in _color_support:
+        _color_support[fd] = _detect_colors(stream)
+    return _color_support[fd]
+
+
+# following from Python cookbook, #475186
+def _detect_colors(stream):
     if not stream.isatty():
         return False  # auto color only on TTYs
     try:
@@ -6,20 +6,24 @@ import os
 import select
 import sys
 import threading
-import copy
 import fcntl
-
-try:
-    import queue
-except ImportError:
-    import Queue as queue
+import heapq
+import math
+import time
+from collections import deque
 
 from parallax.askpass_server import PasswordServer
 from parallax import psshutil
 from parallax import DEFAULT_PARALLELISM, DEFAULT_TIMEOUT
 from parallax.callbacks import DefaultCallbacks
+from parallax.task import base_environ
 
 READ_SIZE = 1 << 16
+WRITE_BUFFER_SIZE = 1 << 16
+
+# How often to check for the exit of processes that have closed their pipes,
+# which the IOMap cannot report.
+EXIT_POLL_INTERVAL = 0.05
 
 
 class FatalError(RuntimeError):
@@ -27,6 +31,34 @@ class FatalError(RuntimeError):
     pass
 
 
+# Connection rate limiters, shared by all Managers in the process.
+_connect_buckets = {}
+_connect_buckets_lock = threading.Lock()
+_CONNECT_BUCKETS_MAX = 8
+
+
+def _connect_bucket(rate, burst):
+    """Returns the shared TokenBucket for the given rate and burst."""
+    if not rate:
+        return None
+    _connect_buckets_lock.acquire()
+    try:
+        key = (rate, burst)
+        if key not in _connect_buckets:
+            if len(_connect_buckets) >= _CONNECT_BUCKETS_MAX:
+                _connect_buckets.clear()
+            _connect_buckets[key] = psshutil.TokenBucket(rate, burst)
+        return _connect_buckets[key]
+    finally:
+        _connect_buckets_lock.release()
+
+
+def _min_wait(wait, limit):
+    if wait is None:
+        return limit
+    return min(wait, limit)
+
+
 class Manager(object):
     """Executes tasks concurrently.
 
@@ -36,6 +68,9 @@ class Manager(object):
     Arguments:
         limit: Maximum number of commands running at once.
         timeout: Maximum allowed execution time in seconds.
+        reactor: IOMap implementation: 'epoll', 'poll' or 'select'.
+        connect_rate: Maximum number of connections started per second.
+        connect_burst: Number of connections that may be started at once.
     """
     def __init__(self,
                  limit=DEFAULT_PARALLELISM,
@@ -44,53 +79,65 @@ class Manager(object):
                  outdir=None,
                  errdir=None,
                  warn_message=True,
-                 callbacks=DefaultCallbacks()):
+                 callbacks=DefaultCallbacks(),
+                 reactor=None,
+                 connect_rate=None,
+                 connect_burst=None):
         # Backwards compatibility with old __init__
         # format: Only argument is an options dict
         if not isinstance(limit, int):
-            if hasattr(limit, 'limit'):
-                self.limit = limit.limit
-            elif hasattr(limit, 'par'):
-                self.limit = limit.par
-            else:
-                self.limit = DEFAULT_PARALLELISM
-            if hasattr(limit, 'timeout'):
-                self.timeout = limit.timeout
-            else:
-                self.timeout = DEFAULT_TIMEOUT
-            if hasattr(limit, 'askpass'):
-                self.askpass = limit.askpass
-            else:
-                self.askpass = False
-            if hasattr(limit, 'outdir'):
-                self.outdir = limit.outdir
-            else:
-                self.outdir = None
-            if hasattr(limit, 'errdir'):
-                self.errdir = limit.errdir
-            else:
-                self.errdir = None
+            opts = limit
+            self.limit = getattr(opts, 'limit',
+                                 getattr(opts, 'par', DEFAULT_PARALLELISM))
+            self.timeout = getattr(opts, 'timeout', DEFAULT_TIMEOUT)
+            self.askpass = getattr(opts, 'askpass', False)
+            self.outdir = getattr(opts, 'outdir', None)
+            self.errdir = getattr(opts, 'errdir', None)
+            reactor = getattr(opts, 'reactor', reactor)
+            connect_rate = getattr(opts, 'connect_rate', connect_rate)
+            connect_burst = getattr(opts, 'connect_burst', connect_burst)
         else:
             self.limit = limit
             self.timeout = timeout
             self.askpass = askpass
             self.outdir = outdir
             self.errdir = errdir
-        self.iomap = make_iomap()
+        self.reactor = reactor
+        self.iomap = make_iomap(reactor)
+        self.connect_bucket = _connect_bucket(connect_rate, connect_burst)
         self.callbacks = callbacks
 
         self.taskcount = 0
-        self.tasks = []
+        self.tasks = deque()
+        # Every task added, in order, for reporting results.
         self.save_tasks = []
         self.running = []
+        # Running tasks whose pipes have all closed, waiting to be reaped.
+        self.exiting = set()
         self.done = []
+        # Heap of (deadline, taskcount, task) for timeouts of started tasks.
+        self.deadlines = []
 
         self.askpass_socket = None
+        # Environment shared by the tasks of a run.
+        self.environ = None
         self.warn_message = warn_message
 
     def run(self):
         """Processes tasks previously added with add_task."""
-        self.save_tasks = copy.copy(self.tasks)
+        for _ in self.iter_finished():
+            pass
+        return self.callbacks.result(self)
+
+    def iter_finished(self):
+        """Processes tasks like run(), yielding each Task as it finishes.
+
+        Closing the generator early interrupts the tasks that are still
+        running and cancels those not yet started.
+        """
+        if self.iomap.closed:
+            # Closed at the end of a previous run.
+            self.iomap = make_iomap(self.reactor)
         if self.outdir or self.errdir:
             writer = Writer(self.outdir, self.errdir)
             writer.start()
@@ -102,24 +149,36 @@ class Manager(object):
                 pass_server = PasswordServer()
                 pass_server.start(self.iomap, self.limit, warn=self.warn_message)
                 self.askpass_socket = pass_server.address
+            self.environ = base_environ(self.askpass_socket)
 
             try:
+                reported = len(self.done)
                 self.update_tasks(writer)
-                wait = None
-                while self.running or self.tasks:
-                    # Opt for efficiency over subsecond timeout accuracy.
-                    if wait is None or wait < 1:
-                        wait = 1
-                    self.iomap.poll(wait)
+                wait = self.check_timeout()
+                while True:
+                    while reported < len(self.done):
+                        yield self.done[reported]
+                        reported += 1
+                    if not (self.running or self.tasks):
+                        break
+                    self.iomap.poll(self.poll_timeout(wait))
                     self.update_tasks(writer)
                     wait = self.check_timeout()
-                return self.callbacks.result(self)
             except KeyboardInterrupt:
                 # This exception handler tries to clean things up and prints
                 # out a nice status message for each interrupted host.
                 self.interrupted()
                 raise
+            except GeneratorExit:
+                self.interrupted()
+                for task in self.running:
+                    task.close(self.iomap)
+                self.running = []
+                self.exiting.clear()
+                self.tasks.clear()
+                raise
         finally:
+            self.iomap.close()
             if writer:
                 writer.signal_quit()
                 writer.join()
@@ -128,6 +187,7 @@ class Manager(object):
     def add_task(self, task):
         """Adds a Task to be processed with run()."""
         self.tasks.append(task)
+        self.save_tasks.append(task)
 
     def update_tasks(self, writer):
         """Reaps tasks and starts as many new ones as allowed."""
@@ -139,9 +199,16 @@ class Manager(object):
     def _start_tasks_once(self, writer):
         """Starts tasks once."""
         while self.tasks and len(self.running) < self.limit:
-            task = self.tasks.pop(0)
+            if (self.connect_bucket and not self.tasks[0].is_local and
+                    not self.connect_bucket.try_acquire()):
+                break
+            task = self.tasks.popleft()
             self.running.append(task)
-            task.start(self.taskcount, self.iomap, writer, self.askpass_socket)
+            task.start(self.taskcount, self.iomap, writer, self.askpass_socket,
+                       environ=self.environ, pipes_closed=self.exiting.add)
+            if self.timeout > 0:
+                heapq.heappush(self.deadlines, (task.timestamp + self.timeout,
+                                                self.taskcount, task))
             self.taskcount += 1
 
     def reap_tasks(self):
@@ -149,34 +216,49 @@ class Manager(object):
 
         After cleaning up, returns the number of tasks that finished.
         """
-        still_running = []
-        finished_count = 0
-        for task in self.running:
-            if task.running():
-                still_running.append(task)
-            else:
-                self.finished(task)
-                finished_count += 1
-        self.running = still_running
-        return finished_count
+        finished = [task for task in self.running if not task.running()]
+        if not finished:
+            return 0
+        for task in finished:
+            self.finished(task)
+        finished = set(finished)
+        self.exiting.difference_update(finished)
+        self.running = [task for task in self.running if task not in finished]
+        return len(finished)
+
+    def poll_timeout(self, wait):
+        """Returns how long the next poll may block, or None for no limit.
+
+        The poll is ended early to start throttled tasks, and to notice the
+        exit of tasks that are no longer waiting on any file descriptor.
+        """
+        if (self.connect_bucket and self.tasks and
+                len(self.running) < self.limit):
+            # A task is waiting for a connection token.
+            wait = _min_wait(wait, self.connect_bucket.delay())
+        if self.exiting:
+            wait = _min_wait(wait, EXIT_POLL_INTERVAL)
+        return wait
 
     def check_timeout(self):
-        """Kills timed-out processes and returns the lowest time left."""
+        """Kills timed-out processes and returns the lowest time left.
+
+        Returns None if no unexpired timeout remains.
+        """
         if self.timeout <= 0:
             return None
 
-        min_timeleft = None
-        for task in self.running:
-            timeleft = self.timeout - task.elapsed()
-            if timeleft <= 0:
+        now = psshutil.monotonic()
+        deadlines = self.deadlines
+        while deadlines:
+            deadline, _, task = deadlines[0]
+            # A reaped task has its exitstatus set; its entry is stale.
+            if task.exitstatus is None and deadline > now:
+                return deadline - now
+            heapq.heappop(deadlines)
+            if task.exitstatus is None:
                 task.timedout()
-                continue
-            if min_timeleft is None or timeleft < min_timeleft:
-                min_timeleft = timeleft
-
-        if min_timeleft is None:
-            return 0
-        return max(0, min_timeleft)
+        return None
 
     def interrupted(self):
         """Cleans up after a keyboard interrupt."""
@@ -200,12 +282,21 @@ class IOMap(object):
 
     The poll method dispatches events to the appropriate handlers.
     """
+    # Maximum number of extra non-blocking polls per call to poll.
+    _drain_cap = 64
+    closed = False
+
     def __init__(self):
         self.readmap = {}
         self.writemap = {}
 
-    def register_read(self, fd, handler):
-        """Registers an IO handler for a file descriptor for reading."""
+    def register_read(self, fd, handler, edge_triggered=False):
+        """Registers an IO handler for a file descriptor for reading.
+
+        With edge_triggered, the handler promises to read until the file
+        descriptor would block, so that implementations which support it
+        only report it again once new data arrives.
+        """
         self.readmap[fd] = handler
 
     def register_write(self, fd, handler):
@@ -219,10 +310,17 @@ class IOMap(object):
         if fd in self.writemap:
             del self.writemap[fd]
 
-    def poll(self, timeout=None):
-        """Performs a poll and dispatches the resulting events."""
+    def close(self):
+        """Releases any resources held by the IOMap itself."""
+        self.closed = True
+
+    def _poll_once(self, timeout):
+        """Performs a single poll and dispatches the resulting events.
+
+        Returns True if there were any events.
+        """
         if not self.readmap and not self.writemap:
-            return
+            return False
         rlist = list(self.readmap)
         wlist = list(self.writemap)
         try:
@@ -231,7 +329,7 @@ class IOMap(object):
             _, e, _ = sys.exc_info()
             errno = e.args[0]
             if errno == EINTR:
-                return
+                return False
             else:
                 raise
         for fd in rlist:
@@ -240,6 +338,27 @@ class IOMap(object):
         for fd in wlist:
             handler = self.writemap[fd]
             handler(fd, self)
+        return bool(rlist or wlist)
+
+    def poll(self, timeout=None):
+        """Performs a poll and dispatches the resulting events.
+
+        The timeout is in seconds; None waits until an event arrives. With
+        no file descriptors registered, just sleeps for the timeout.
+
+        When there were events, keeps polling without blocking, up to
+        _drain_cap more times, while further events are ready. This
+        handles bursts of output from many tasks in one call, instead
+        of returning to the Manager after each poll.
+        """
+        if not self.readmap and not self.writemap:
+            if timeout:
+                time.sleep(timeout)
+            return
+        if self._poll_once(timeout):
+            for _ in range(self._drain_cap):
+                if not self._poll_once(0):
+                    break
 
 
 class PollIOMap(IOMap):
@@ -252,32 +371,48 @@ class PollIOMap(IOMap):
         self._poller = select.poll()
         super(PollIOMap, self).__init__()
 
-    def register_read(self, fd, handler):
+    def _mask(self, fd):
+        mask = 0
+        if fd in self.readmap:
+            mask |= select.POLLIN
+        if fd in self.writemap:
+            mask |= select.POLLOUT
+        return mask
+
+    def register_read(self, fd, handler, edge_triggered=False):
         """Registers an IO handler for a file descriptor for reading."""
         super(PollIOMap, self).register_read(fd, handler)
-        self._poller.register(fd, select.POLLIN)
+        # Registering again replaces the mask, so include both directions.
+        self._poller.register(fd, self._mask(fd))
 
     def register_write(self, fd, handler):
         """Registers an IO handler for a file descriptor for writing."""
         super(PollIOMap, self).register_write(fd, handler)
-        self._poller.register(fd, select.POLLOUT)
+        self._poller.register(fd, self._mask(fd))
 
     def unregister(self, fd):
         """Unregisters the given file descriptor."""
+        if self._mask(fd):
+            self._poller.unregister(fd)
         super(PollIOMap, self).unregister(fd)
-        self._poller.unregister(fd)
 
-    def poll(self, timeout=None):
-        """Performs a poll and dispatches the resulting events."""
+    def _poll_once(self, timeout):
+        """Performs a single poll and dispatches the resulting events.
+
+        Returns True if there were any events.
+        """
         if not self.readmap and not self.writemap:
-            return
+            return False
+        if timeout is not None:
+            # poll takes milliseconds; round up to avoid spinning.
+            timeout = int(math.ceil(timeout * 1000))
         try:
             event_list = self._poller.poll(timeout)
         except select.error:
             _, e, _ = sys.exc_info()
             errno = e.args[0]
             if errno == EINTR:
-                return
+                return False
             else:
                 raise
         for fd, event in event_list:
@@ -287,27 +422,119 @@ class PollIOMap(IOMap):
             if event & (select.POLLOUT | select.POLLERR):
                 handler = self.writemap[fd]
                 handler(fd, self)
+        return bool(event_list)
+
+
+class EpollIOMap(IOMap):
+    """A manager for file descriptors and their associated handlers.
+
+    The poll method dispatches events to the appropriate handlers.
+    Note that `select.epoll` is only available on Linux. Unlike `select`
+    and `poll`, the cost of each wakeup depends on the number of ready
+    file descriptors rather than on the number of registered ones.
+    File descriptors registered as edge_triggered are only reported
+    again once new data arrives.
+    """
+    def __init__(self):
+        self._epoll = select.epoll()
+        psshutil.set_cloexec(self._epoll)
+        self._masks = {}
+        super(EpollIOMap, self).__init__()
+
+    def _register(self, fd, mask):
+        old = self._masks.get(fd)
+        if old is None:
+            self._epoll.register(fd, mask)
+        else:
+            mask |= old
+            self._epoll.modify(fd, mask)
+        self._masks[fd] = mask
+
+    def register_read(self, fd, handler, edge_triggered=False):
+        """Registers an IO handler for a file descriptor for reading."""
+        super(EpollIOMap, self).register_read(fd, handler)
+        if edge_triggered:
+            self._register(fd, select.EPOLLIN | select.EPOLLET)
+        else:
+            self._register(fd, select.EPOLLIN)
+
+    def register_write(self, fd, handler):
+        """Registers an IO handler for a file descriptor for writing."""
+        super(EpollIOMap, self).register_write(fd, handler)
+        self._register(fd, select.EPOLLOUT)
+
+    def unregister(self, fd):
+        """Unregisters the given file descriptor."""
+        super(EpollIOMap, self).unregister(fd)
+        if self._masks.pop(fd, None) is not None:
+            self._epoll.unregister(fd)
+
+    def close(self):
+        """Closes the epoll file descriptor."""
+        self._epoll.close()
+        self._masks.clear()
+        super(EpollIOMap, self).close()
+
+    def _poll_once(self, timeout):
+        """Performs a single poll and dispatches the resulting events.
 
+        Returns True if there were any events.
+        """
+        if not self.readmap and not self.writemap:
+            return False
+        if timeout is None:
+            timeout = -1
+        try:
+            event_list = self._epoll.poll(timeout)
+        except (select.error, IOError, OSError):
+            _, e, _ = sys.exc_info()
+            errno = e.args[0]
+            if errno == EINTR:
+                return False
+            else:
+                raise
+        for fd, event in event_list:
+            if event & (select.EPOLLIN | select.EPOLLHUP):
+                handler = self.readmap.get(fd) or self.writemap.get(fd)
+                if handler:
+                    handler(fd, self)
+            if event & (select.EPOLLOUT | select.EPOLLERR):
+                handler = self.writemap.get(fd) or self.readmap.get(fd)
+                if handler:
+                    handler(fd, self)
+        return bool(event_list)
 
-def make_iomap():
-    """Return a new IOMap or PollIOMap as appropriate.
 
-    Since `select.poll` is not implemented on all platforms, this ensures that
-    the most appropriate implementation is used.
+REACTORS = ('epoll', 'poll', 'select')
+
+
+def make_iomap(reactor=None):
+    """Return a new EpollIOMap, PollIOMap or IOMap as appropriate.
+
+    reactor names the preferred implementation, one of REACTORS. Since
+    `select.epoll` and `select.poll` are not implemented on all platforms,
+    the next one in the list is used when the preferred one is missing.
+    By default the most efficient available implementation is used.
     """
-    if hasattr(select, 'poll'):
-        return PollIOMap()
+    if reactor is None:
+        reactor = REACTORS[0]
+    if reactor not in REACTORS:
+        raise ValueError("Unknown reactor: %s" % reactor)
+    for name in REACTORS[REACTORS.index(reactor):]:
+        if name == 'epoll' and hasattr(select, 'epoll'):
+            return EpollIOMap()
+        if name == 'poll' and hasattr(select, 'poll'):
+            return PollIOMap()
     return IOMap()
 
 
 class Writer(threading.Thread):
-    """Thread that writes to files by processing requests from a Queue.
+    """Thread that writes to files by processing requests from a queue.
 
     Until AIO becomes widely available, it is impossible to make a nonblocking
     write to an ordinary file.  The Writer thread processes all writing to
     ordinary files so that the main thread can work without blocking.
     """
-    OPEN = object()
     EOF = object()
     ABORT = object()
 
@@ -315,29 +542,70 @@ class Writer(threading.Thread):
         threading.Thread.__init__(self)
         # A daemon thread automatically dies if the program is terminated.
         self.setDaemon(True)
-        self.queue = queue.Queue()
+        # Requests are appended by the main thread and taken by the Writer,
+        # which waits on the event while the queue is empty.
+        self.queue = deque()
+        self.wakeup = threading.Event()
         self.outdir = outdir
         self.errdir = errdir
 
         self.host_counts = {}
         self.files = {}
+        self.files_lock = threading.Lock()
+
+    # Maximum number of queued requests handled per wakeup.
+    _drain_max = 64
 
     def run(self):
         while True:
-            filename, data = self.queue.get()
-            if filename == self.ABORT:
-                return
+            # Chunks are grouped by file so that each file gets at most one
+            # write per batch.
+            pending = {}
+            for filename, data in self._get_batch():
+                if filename == self.ABORT:
+                    self._write_pending(pending)
+                    for dest in list(self.files.values()):
+                        dest.flush()
+                    return
 
-            if data == self.OPEN:
-                self.files[filename] = open(filename, 'wb', buffering=1)
-                psshutil.set_cloexec(self.files[filename])
-            else:
-                dest = self.files[filename]
                 if data == self.EOF:
+                    self.files_lock.acquire()
+                    try:
+                        dest = self.files.pop(filename)
+                    finally:
+                        self.files_lock.release()
+                    chunks = pending.pop(filename, None)
+                    if chunks:
+                        self._write_chunks(dest, chunks)
                     dest.close()
                 else:
-                    dest.write(data)
-                    dest.flush()
+                    pending.setdefault(filename, []).append(data)
+            self._write_pending(pending)
+
+    def _write_pending(self, pending):
+        for filename, chunks in pending.items():
+            self._write_chunks(self.files[filename], chunks)
+
+    def _write_chunks(self, dest, chunks):
+        if len(chunks) == 1:
+            dest.write(chunks[0])
+        else:
+            dest.write(b''.join(chunks))
+
+    def _get_batch(self):
+        """Waits for requests, then takes up to _drain_max of them."""
+        while not self.queue:
+            self.wakeup.wait()
+            self.wakeup.clear()
+        batch = []
+        popleft = self.queue.popleft
+        while self.queue and len(batch) < self._drain_max:
+            batch.append(popleft())
+        return batch
+
+    def _put(self, request):
+        self.queue.append(request)
+        self.wakeup.set()
 
     def open_files(self, host):
         """Called from another thread to create files for stdout and stderr.
@@ -356,20 +624,32 @@ class Writer(threading.Thread):
                 filename = host
             if self.outdir:
                 outfile = os.path.join(self.outdir, filename)
-                self.queue.put((outfile, self.OPEN))
+                self._open(outfile)
             if self.errdir:
                 errfile = os.path.join(self.errdir, filename)
-                self.queue.put((errfile, self.OPEN))
+                self._open(errfile)
         return outfile, errfile
 
+    def _open(self, filename):
+        """Opens filename for writing before any writes are queued to it."""
+        # Files are block buffered and flushed when closed; line buffering
+        # does not apply to binary files.
+        dest = open(filename, 'wb', buffering=WRITE_BUFFER_SIZE)
+        psshutil.set_cloexec(dest)
+        self.files_lock.acquire()
+        try:
+            self.files[filename] = dest
+        finally:
+            self.files_lock.release()
+
     def write(self, filename, data):
         """Called from another thread to enqueue a write."""
-        self.queue.put((filename, data))
+        self._put((filename, data))
 
     def close(self, filename):
         """Called from another thread to close the given file."""
-        self.queue.put((filename, self.EOF))
+        self._put((filename, self.EOF))
 
     def signal_quit(self):
         """Called from another thread to request the Writer to quit."""
-        self.queue.put((self.ABORT, None))
+        self._put((self.ABORT, None))
@@ -1,12 +1,29 @@
 # Copyright (c) 2009-2012, Andrew McNabb
 # Copyright (c) 2003-2008, Brent N. Chun
 
+import errno
 import fcntl
+import os
+import re
+import shutil
 import sys
 import subprocess
+import threading
+import time
 
 HOST_FORMAT = 'Host format is [user@]host[:port] [user]'
 
+# Clock for measuring intervals, unaffected by changes to the system time
+# where available (Python 3.3+).
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Splits "[user@]host[:port]" at the first '@' and the last ':'.
+_HOST_RE = re.compile(r'(?:([^@]*)@)?(.*?)(?::([^:]*))?\Z', re.DOTALL)
+
+# Below this many directories, makedirs_parallel creates them serially,
+# since starting threads costs more than it saves.
+PARALLEL_MKDIR_THRESHOLD = 32
+
 
 def read_host_files(paths, default_user=None, default_port=None):
     """Reads the given host files.
@@ -26,14 +43,14 @@ def read_host_file(path, default_user=None, default_port=None):
     Lines are of the form: host[:port] [login].
     Returns a list of (host, port, user) triples.
     """
-    lines = []
     f = open(path)
-    for line in f:
-        lines.append(line.strip())
-    f.close()
+    try:
+        data = f.read()
+    finally:
+        f.close()
 
     hosts = []
-    for line in lines:
+    for line in data.splitlines():
         # Skip blank lines or lines starting with #
         line = line.strip()
         if not line or line.startswith('#'):
@@ -89,32 +106,67 @@ def parse_host(host, default_user=None, default_port=None):
 
     Returns a (host, port, user) triple.
     """
-    # TODO: when we stop supporting Python 2.4, switch to using str.partition.
-    user = default_user
-    port = default_port
-    if '@' in host:
-        user, host = host.split('@', 1)
-    if ':' in host:
-        host, port = host.rsplit(':', 1)
+    user, host, port = _HOST_RE.match(host).groups()
+    if user is None:
+        user = default_user
+    if port is None:
+        port = default_port
     return (host, port, user)
 
 
+def _which(name):
+    """Returns the path of the executable name on PATH, or None."""
+    if hasattr(shutil, 'which'):
+        return shutil.which(name)
+    for dirname in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(dirname, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+_OPENSSH_VERSION_RE = re.compile(r'OpenSSH_(\d+)\.(\d+)')
+_ssh_version = []
+
+
+def ssh_version():
+    """Returns the (major, minor) version of the OpenSSH ssh on PATH.
+
+    Returns None if ssh is not OpenSSH or cannot be run. The result is
+    computed once per process.
+    """
+    if not _ssh_version:
+        version = None
+        try:
+            p = subprocess.Popen(['ssh', '-V'], stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 universal_newlines=True)
+            match = _OPENSSH_VERSION_RE.search(p.communicate()[0])
+            if match:
+                version = (int(match.group(1)), int(match.group(2)))
+        except (OSError, IOError):
+            pass
+        _ssh_version.append(version)
+    return _ssh_version[0]
+
+
 def get_pacemaker_nodes():
     """Get the list of nodes from crm_node -l.
 
     Returns a list of (host, port, user) triples.
     """
     hosts = []
-    if subprocess.call("which crm_node >/dev/null 2>&1", shell=True) != 0:
+    crm_node = _which('crm_node')
+    if crm_node is None:
         sys.stderr.write('crm_node not available\n')
         return hosts
     cmd = "crm_node -l"
-    p = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE)
     try:
+        p = subprocess.Popen([crm_node, '-l'], stdout=subprocess.PIPE,
+                             universal_newlines=True)
         outp = p.communicate()[0]
-        p.wait()
         rc = p.returncode
-    except IOError as msg:
+    except (OSError, IOError) as msg:
         sys.stderr.write('%s failed: %s\n' % (cmd, msg))
         return hosts
     if rc != 0:
@@ -128,12 +180,123 @@ def get_pacemaker_nodes():
     return hosts
 
 
+def makedirs(path, mode=0o777):
+    """Creates a directory and any missing parents, like os.makedirs.
+
+    Does nothing if the directory already exists. This costs a single
+    mkdir in the common case instead of a stat followed by a mkdir.
+    """
+    try:
+        os.makedirs(path, mode)
+    except OSError:
+        _, e, _ = sys.exc_info()
+        if e.errno != errno.EEXIST or not os.path.isdir(path):
+            raise
+
+
+def makedirs_parallel(paths, workers):
+    """Creates the given directories using up to `workers` threads.
+
+    Useful when there are many directories on a network filesystem,
+    where each mkdir is a round trip. The parents of the directories
+    should already exist, since creating a shared parent from several
+    threads races. Raises the first error encountered.
+    """
+    paths = list(paths)
+    workers = min(workers, len(paths))
+    if workers <= 1 or len(paths) < PARALLEL_MKDIR_THRESHOLD:
+        for path in paths:
+            makedirs(path)
+        return
+
+    pending = iter(paths)
+    lock = threading.Lock()
+    errors = []
+
+    def worker():
+        while not errors:
+            lock.acquire()
+            try:
+                path = next(pending, None)
+            finally:
+                lock.release()
+            if path is None:
+                return
+            try:
+                makedirs(path)
+            except OSError:
+                errors.append(sys.exc_info()[1])
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+
+class TokenBucket(object):
+    """Rate limiter handing out tokens at a fixed rate.
+
+    Tokens accumulate at `rate` per second up to `burst`, so that after
+    a quiet period up to `burst` tokens can be taken at once. May be
+    shared between threads.
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(1, burst or rate)
+        self.tokens = self.burst
+        self.stamp = monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = monotonic()
+        elapsed = max(0, now - self.stamp)
+        self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+        self.stamp = now
+
+    def try_acquire(self):
+        """Takes a token if one is available. Returns True on success."""
+        self.lock.acquire()
+        try:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def delay(self):
+        """Returns the number of seconds until a token is available."""
+        self.lock.acquire()
+        try:
+            self._refill()
+            if self.tokens >= 1:
+                return 0
+            return (1 - self.tokens) / self.rate
+        finally:
+            self.lock.release()
+
+
 def set_cloexec(filelike):
     """Sets the underlying filedescriptor to automatically close on exec.
 
     If set_cloexec is called for all open files, then subprocess.Popen does
     not require the close_fds option.
     """
-    fcntl.fcntl(filelike.fileno(), fcntl.FD_CLOEXEC, 1)
+    fd = filelike.fileno()
+    if hasattr(os, 'set_inheritable'):
+        os.set_inheritable(fd, False)
+    else:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+
+
+def set_nonblocking(filelike):
+    """Puts the underlying filedescriptor in non-blocking mode."""
+    fd = filelike.fileno()
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
 
 # vim:ts=4:sw=4:et:
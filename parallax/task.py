@@ -1,15 +1,16 @@
 # Copyright (c) 2009-2012, Andrew McNabb
 # Copyright (c) 2013, Kristoffer Gronlund
 
-from errno import EINTR
+from errno import EINTR, EAGAIN
 from subprocess import Popen, PIPE
 import os
 import signal
 import sys
-import time
+import threading
 import traceback
 
 from parallax import askpass_client
+from parallax import psshutil
 
 BUFFER_SIZE = 1 << 16
 
@@ -21,6 +22,44 @@ except NameError:
 
 PY2 = sys.version[0] == '2'
 
+# os.readv lets output be read into a reused buffer (Python 3.3+).
+_HAVE_READV = hasattr(os, 'readv')
+
+# Serializes streamed output from tasks running in different threads.
+_stdout_lock = threading.Lock()
+
+
+def _write_stdout(data):
+    """Writes bytes to stdout, through the binary layer if it has one."""
+    _stdout_lock.acquire()
+    try:
+        # Flush the TextIOWrapper before writing to the binary buffer.
+        sys.stdout.flush()
+        try:
+            sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+        except AttributeError:
+            sys.stdout.write(data)
+            sys.stdout.flush()
+    finally:
+        _stdout_lock.release()
+
+
+def base_environ(askpass_socket=None):
+    """Returns the environment variables common to all task processes."""
+    environ = dict(os.environ)
+    # Disable the GNOME pop-up password dialog and allow ssh to use
+    # askpass.py to get a provided password.  If the module file is
+    # askpass.pyc, we replace the extension.
+    environ['SSH_ASKPASS'] = askpass_client.executable_path()
+    if askpass_socket:
+        environ['PARALLAX_ASKPASS_SOCKET'] = askpass_socket
+    # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
+    # if DISPLAY is unset.
+    if 'DISPLAY' not in environ:
+        environ['DISPLAY'] = 'parallax-gibberish'
+    return environ
+
 
 class Task(object):
     """Starts a process and manages its input and output.
@@ -40,25 +79,18 @@ class Task(object):
                  inline=False,
                  inline_stdout=False,
                  default_user=None,
-                 is_local=False):
+                 is_local=False,
+                 stream_out=False):
 
         # Backwards compatibility:
         if not isinstance(verbose, bool):
             opts = verbose
             verbose = opts.verbose
             quiet = opts.quiet
-            try:
-                print_out = bool(opts.print_out)
-            except AttributeError:
-                print_out = False
-            try:
-                inline = bool(opts.inline)
-            except AttributeError:
-                inline = False
-            try:
-                inline_stdout = bool(opts.inline_stdout)
-            except AttributeError:
-                inline_stdout = False
+            print_out = bool(getattr(opts, 'print_out', False))
+            inline = bool(getattr(opts, 'inline', False))
+            inline_stdout = bool(getattr(opts, 'inline_stdout', False))
+            stream_out = bool(getattr(opts, 'stream_out', False))
             default_user = opts.user
 
         self.exitstatus = None
@@ -73,6 +105,8 @@ class Task(object):
             self.pretty_host = '@'.join((user, self.pretty_host))
         if port:
             self.pretty_host = ':'.join((self.pretty_host, port))
+        # Prefix for output lines when output from several hosts is mixed.
+        self.host_prefix = host.encode() + b': '
 
         self.proc = None
         self.writer = None
@@ -81,12 +115,21 @@ class Task(object):
         self.killed = False
         self.inputbuffer = stdin
         self.byteswritten = 0
-        self.outputbuffer = bytes()
-        self.errorbuffer = bytes()
+        # Output is collected in bytearrays, which grow in amortized
+        # constant time, and only converted to bytes when read.
+        self._outbuf = bytearray()
+        self._errbuf = bytearray()
+        self._outbytes = None
+        self._errbytes = None
+        # Reusable read buffer, allocated while the output pipes are open.
+        self._rbuf = None
+        self._rview = None
 
         self.stdin = None
         self.stdout = None
         self.stderr = None
+        # Called with the task once all of its pipes have closed.
+        self.pipes_closed = None
         self.outfile = None
         self.errfile = None
 
@@ -95,31 +138,57 @@ class Task(object):
         self.quiet = quiet
         self.print_out = print_out
         self.inline = inline
-        self.inline_stdout = inline or inline_stdout
-
-    def start(self, nodenum, iomap, writer, askpass_socket=None):
-        """Starts the process and registers files with the IOMap."""
+        self.inline_stdout = (inline or inline_stdout) and not stream_out
+        self.stream_out = stream_out
+        # Incomplete last line of streamed output.
+        self.partial_line = bytearray()
+
+    @property
+    def outputbuffer(self):
+        """The standard output collected so far."""
+        if self._outbytes is None:
+            self._outbytes = bytes(self._outbuf)
+        return self._outbytes
+
+    @outputbuffer.setter
+    def outputbuffer(self, value):
+        self._outbuf = bytearray(value)
+        self._outbytes = None
+
+    @property
+    def errorbuffer(self):
+        """The standard error collected so far."""
+        if self._errbytes is None:
+            self._errbytes = bytes(self._errbuf)
+        return self._errbytes
+
+    @errorbuffer.setter
+    def errorbuffer(self, value):
+        self._errbuf = bytearray(value)
+        self._errbytes = None
+
+    def start(self, nodenum, iomap, writer, askpass_socket=None,
+              environ=None, pipes_closed=None):
+        """Starts the process and registers files with the IOMap.
+
+        environ is the result of base_environ(askpass_socket), which may be
+        shared between tasks; it is built here if not given.  pipes_closed,
+        if given, is called with the task when its last pipe is closed.
+        """
         self.writer = writer
+        self.pipes_closed = pipes_closed
 
         if writer:
             self.outfile, self.errfile = writer.open_files(self.pretty_host)
 
         # Set up the environment.
-        environ = dict(os.environ)
+        if environ is None:
+            environ = base_environ(askpass_socket)
+        environ = environ.copy()
         environ['PARALLAX_NODENUM'] = str(nodenum)
         environ['PARALLAX_HOST'] = self.host
-        # Disable the GNOME pop-up password dialog and allow ssh to use
-        # askpass.py to get a provided password.  If the module file is
-        # askpass.pyc, we replace the extension.
-        environ['SSH_ASKPASS'] = askpass_client.executable_path()
-        if askpass_socket:
-            environ['PARALLAX_ASKPASS_SOCKET'] = askpass_socket
         if self.verbose:
             environ['PARALLAX_ASKPASS_VERBOSE'] = '1'
-        # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
-        # if DISPLAY is unset.
-        if 'DISPLAY' not in environ:
-            environ['DISPLAY'] = 'parallax-gibberish'
 
         # Create the subprocess.  Since we carefully call set_cloexec() on
         # all open files, we specify close_fds=False.
@@ -130,16 +199,25 @@ class Task(object):
             self.proc = Popen(self.cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE,
                     close_fds=False, start_new_session=True, env=environ, shell=self.is_local)
 
-        self.timestamp = time.time()
+        self.timestamp = psshutil.monotonic()
         if self.inputbuffer:
             self.stdin = self.proc.stdin
             iomap.register_write(self.stdin.fileno(), self.handle_stdin)
         else:
             self.proc.stdin.close()
+        if _HAVE_READV:
+            self._rbuf = bytearray(BUFFER_SIZE)
+            self._rview = memoryview(self._rbuf)
+        # The output handlers read until the pipes are drained, which
+        # allows the IOMap to use edge-triggered notification for them.
         self.stdout = self.proc.stdout
-        iomap.register_read(self.stdout.fileno(), self.handle_stdout)
+        psshutil.set_nonblocking(self.stdout)
+        iomap.register_read(self.stdout.fileno(), self.handle_stdout,
+                            edge_triggered=True)
         self.stderr = self.proc.stderr
-        iomap.register_read(self.stderr.fileno(), self.handle_stderr)
+        psshutil.set_nonblocking(self.stderr)
+        iomap.register_read(self.stderr.fileno(), self.handle_stderr,
+                            edge_triggered=True)
 
     def _kill(self):
         """Signals the process to terminate."""
@@ -169,11 +247,15 @@ class Task(object):
 
     def elapsed(self):
         """Finds the time in seconds since the process was started."""
-        return time.time() - self.timestamp
+        return psshutil.monotonic() - self.timestamp
+
+    def pipes_open(self):
+        """Finds if any of the process's pipes are still open."""
+        return bool(self.stdin or self.stdout or self.stderr)
 
     def running(self):
         """Finds if the process has terminated and saves the return code."""
-        if self.stdin or self.stdout or self.stderr:
+        if self.pipes_open():
             return True
         if self.proc:
             self.exitstatus = self.proc.poll()
@@ -213,65 +295,147 @@ class Task(object):
             iomap.unregister(self.stdin.fileno())
             self.stdin.close()
             self.stdin = None
+            self._pipe_closed()
 
     def handle_stdout(self, fd, iomap):
-        """Called when the process's standard output is ready for reading."""
-        try:
-            buf = os.read(fd, BUFFER_SIZE)
-            if buf:
-                if self.inline_stdout:
-                    if self.quiet:
-                        self.outputbuffer += "%s: %s" % (self.host, buf)
-                    else:
-                        self.outputbuffer += buf
-                if self.outfile:
-                    self.writer.write(self.outfile, buf)
-                if self.print_out:
-                    for l in buf.split('\n'):
-                        sys.stdout.write('%s: %s\n' % (self.host, l))
-            else:
-                self.close_stdout(iomap)
-        except (OSError, IOError):
-            _, e, _ = sys.exc_info()
-            if e.errno != EINTR:
-                self.close_stdout(iomap)
-                self.log_exception(e)
+        """Called when the process's standard output is ready for reading.
+
+        Reads until the pipe is drained or closed.
+        """
+        while self.stdout:
+            try:
+                data = self._read(fd)
+                if data:
+                    if self.inline_stdout:
+                        if self.quiet:
+                            self._outbuf.extend(self.host_prefix)
+                        self._outbuf.extend(data)
+                        self._outbytes = None
+                    if self.outfile or self.print_out or self.stream_out:
+                        buf = bytes(data)
+                    if self.outfile:
+                        self.writer.write(self.outfile, buf)
+                    if self.print_out:
+                        self.print_stdout(buf)
+                    if self.stream_out:
+                        self.stream_stdout(buf)
+                else:
+                    self.close_stdout(iomap)
+            except (OSError, IOError):
+                _, e, _ = sys.exc_info()
+                if e.errno == EAGAIN:
+                    return
+                if e.errno != EINTR:
+                    self.close_stdout(iomap)
+                    self.log_exception(e)
+
+    def print_stdout(self, buf):
+        """Writes buf to stdout with each line prefixed by host."""
+        prefix = self.host_prefix
+        out = prefix + buf.replace(b'\n', b'\n' + prefix)
+        if buf.endswith(b'\n'):
+            out = out[:-len(prefix)]
+        else:
+            out += b'\n'
+        _write_stdout(out)
+
+    def stream_stdout(self, buf):
+        """Writes the complete lines in buf to stdout, prefixed by host.
+
+        Incomplete lines are held back until the rest of the line
+        arrives, so that output from different hosts is not mixed up.
+        A partial line longer than BUFFER_SIZE is written out as a line
+        of its own, so that output without newlines is not held in memory.
+        """
+        partial = self.partial_line
+        partial += buf
+        end = partial.rfind(b'\n') + 1
+        if end:
+            prefix = self.host_prefix
+            lines = partial[:end - 1].split(b'\n')
+            _write_stdout(prefix + (b'\n' + prefix).join(lines) + b'\n')
+            del partial[:end]
+        elif len(partial) >= BUFFER_SIZE:
+            _write_stdout(self.host_prefix + partial + b'\n')
+            del partial[:]
 
     def close_stdout(self, iomap):
+        if self.partial_line:
+            self.stream_stdout(b'\n')
         if self.stdout:
             iomap.unregister(self.stdout.fileno())
             self.stdout.close()
             self.stdout = None
+            self._release_read_buffer()
+            self._pipe_closed()
         if self.outfile:
             self.writer.close(self.outfile)
             self.outfile = None
 
+    def _read(self, fd):
+        """Reads up to BUFFER_SIZE bytes from fd.
+
+        Where os.readv is available, the data is read into the task's reusable
+        buffer and a memoryview of it is returned; it must be copied before
+        the next read.
+        """
+        if self._rview is None:
+            return os.read(fd, BUFFER_SIZE)
+        return self._rview[:os.readv(fd, [self._rbuf])]
+
+    def _release_read_buffer(self):
+        if not self.stdout and not self.stderr:
+            self._rbuf = None
+            self._rview = None
+
+    def _pipe_closed(self):
+        if self.pipes_closed and not self.pipes_open():
+            self.pipes_closed(self)
+
     def handle_stderr(self, fd, iomap):
-        """Called when the process's standard error is ready for reading."""
-        try:
-            buf = os.read(fd, BUFFER_SIZE)
-            if buf:
-                if self.inline:
-                    self.errorbuffer += buf
-                if self.errfile:
-                    self.writer.write(self.errfile, buf)
-            else:
-                self.close_stderr(iomap)
-        except (OSError, IOError):
-            _, e, _ = sys.exc_info()
-            if e.errno != EINTR:
-                self.close_stderr(iomap)
-                self.log_exception(e)
+        """Called when the process's standard error is ready for reading.
+
+        Reads until the pipe is drained or closed.
+        """
+        while self.stderr:
+            try:
+                data = self._read(fd)
+                if data:
+                    if self.inline:
+                        self._errbuf.extend(data)
+                        self._errbytes = None
+                    if self.errfile:
+                        self.writer.write(self.errfile, bytes(data))
+                else:
+                    self.close_stderr(iomap)
+            except (OSError, IOError):
+                _, e, _ = sys.exc_info()
+                if e.errno == EAGAIN:
+                    return
+                if e.errno != EINTR:
+                    self.close_stderr(iomap)
+                    self.log_exception(e)
 
     def close_stderr(self, iomap):
         if self.stderr:
             iomap.unregister(self.stderr.fileno())
             self.stderr.close()
             self.stderr = None
+            self._release_read_buffer()
+            self._pipe_closed()
         if self.errfile:
             self.writer.close(self.errfile)
             self.errfile = None
 
+    def close(self, iomap):
+        """Closes the process's pipes and waits for it to terminate."""
+        self.close_stdin(iomap)
+        self.close_stdout(iomap)
+        self.close_stderr(iomap)
+        if self.proc:
+            self.exitstatus = self.proc.wait()
+            self.proc = None
+
     def log_exception(self, e):
         """Saves a record of the most recent exception for error reporting."""
         if self.verbose:
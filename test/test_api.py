@@ -2,6 +2,8 @@
 
 # Copyright (c) 2013, Kristoffer Gronlund
 
+import atexit
+import copy
 import os
 import sys
 import unittest
@@ -9,60 +11,123 @@ import tempfile
 import shutil
 
 basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
-sys.path.insert(0, "%s" % basedir)
+sys.path.insert(0, basedir)
 
-print(basedir)
+# parallax and the test configuration are loaded by setup_tests() when
+# the first test runs, so that the module can be imported, for example
+# to list the tests, without TEST_HOSTS and TEST_USER being set.
+para = None
+g_hosts = None
+g_user = None
+g_ctl_dir = None
+g_opts = None
 
-import parallax as para
 
-if os.getenv("TEST_HOSTS") is None:
-    raise Exception("Must define TEST_HOSTS")
-g_hosts = os.getenv("TEST_HOSTS").split()
+def setup_tests():
+    global para, g_hosts, g_user, g_ctl_dir, g_opts
+    if para is not None:
+        return
+    try:
+        g_hosts = tuple(os.environ["TEST_HOSTS"].split())
+        g_user = os.environ["TEST_USER"]
+    except KeyError as err:
+        raise Exception("Must define %s" % err.args[0])
 
-if os.getenv("TEST_USER") is None:
-    raise Exception("Must define TEST_USER")
-g_user = os.getenv("TEST_USER")
+    import parallax as para
 
+    # All tests share one ControlMaster socket directory, so that every
+    # operation after the first reuses the connection to each host. The
+    # master connections are closed when the test run exits.
+    g_ctl_dir = tempfile.mkdtemp()
 
-class CallTest(unittest.TestCase):
-    def testSimpleCall(self):
-        opts = para.Options()
-        opts.default_user = g_user
-        for host, result in para.call(g_hosts, "ls -l /", opts).items():
+    # Options shared by all tests; copy before changing them in a test.
+    g_opts = para.Options()
+    g_opts.default_user = g_user
+    g_opts.control_dir = g_ctl_dir
+
+    atexit.register(close_connections)
+
+
+def close_connections():
+    para.close_connections(g_hosts, g_opts)
+    shutil.rmtree(g_ctl_dir)
+
+
+_LOAD_AVG = b"load average"
+
+# Slurped files are written to tmpfs when available, keeping local disk
+# writeback out of the transfer times.
+if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+    g_local_tmp = '/dev/shm'
+else:
+    g_local_tmp = None
+
+
+class ApiTestCase(unittest.TestCase):
+    def setUp(self):
+        setup_tests()
+
+
+class CallTest(ApiTestCase):
+    def _run_and_check(self, cmdline, check_output=None):
+        """
+        Runs cmdline on all hosts, checking that it succeeds and that
+        check_output(stdout) holds for each host.
+        """
+        for host, result in para.call_iter(g_hosts, cmdline, g_opts):
             if isinstance(result, para.Error):
                 raise result
             rc, out, err = result
             self.assertEqual(rc, 0)
-            self.assertTrue(len(out) > 0)
+            if check_output is not None:
+                self.assertTrue(check_output(out))
+
+    def testSimpleCall(self):
+        self._run_and_check("ls -l /", lambda out: len(out) > 0)
 
     def testUptime(self):
-        opts = para.Options()
-        opts.default_user = g_user
-        for host, result in para.call(g_hosts, "uptime", opts).items():
-            if isinstance(result, para.Error):
-                raise result
-            rc, out, err = result
-            self.assertEqual(rc, 0)
-            self.assertTrue(out.decode("utf8").find("load average") != -1)
+        self._run_and_check("uptime", lambda out: _LOAD_AVG in out)
 
     def testFailingCall(self):
-        opts = para.Options()
-        opts.default_user = g_user
+        opts = g_opts
         for host, result in para.call(g_hosts, "touch /foofoo/barbar/jfikjfdj", opts).items():
             self.assertTrue(isinstance(result, para.Error))
             self.assertTrue(str(result).find('with error code') != -1)
 
-
-class CopySlurpTest(unittest.TestCase):
+    def _check_batch(self, opts):
+        cmds = ["ls -l /", "uptime", "touch /foofoo/barbar/jfikjfdj"]
+        for host, result in para.call_batch(g_hosts, cmds, opts).items():
+            if isinstance(result, para.Error):
+                raise result
+            self.assertEqual(len(result), 3)
+            (rc1, out1, _), (rc2, out2, _), (rc3, _, err3) = result
+            self.assertEqual(rc1, 0)
+            self.assertTrue(len(out1) > 0)
+            self.assertFalse(out1.startswith(host.encode() + b': '))
+            self.assertEqual(rc2, 0)
+            self.assertTrue(_LOAD_AVG in out2)
+            self.assertNotEqual(rc3, 0)
+            self.assertTrue(len(err3) > 0)
+
+    def testBatchCall(self):
+        self._check_batch(g_opts)
+
+    def testQuietBatchCall(self):
+        opts = copy.copy(g_opts)
+        opts.quiet = True
+        self._check_batch(opts)
+
+
+class CopySlurpTest(ApiTestCase):
     def setUp(self):
-        self.tmpDir = tempfile.mkdtemp()
+        ApiTestCase.setUp(self)
+        self.tmpDir = tempfile.mkdtemp(dir=g_local_tmp)
 
     def tearDown(self):
         shutil.rmtree(self.tmpDir)
 
     def testCopyFile(self):
-        opts = para.Options()
-        opts.default_user = g_user
+        opts = copy.copy(g_opts)
         opts.localdir = self.tmpDir
         by_host = para.copy(g_hosts, "/etc/hosts", "/tmp/para.test", opts)
         for host, result in by_host.items():
@@ -71,18 +136,46 @@ class CopySlurpTest(unittest.TestCase):
             rc, _, _ = result
             self.assertEqual(rc, 0)
 
+        suffixes = dict((h, h + '/para.test') for h in g_hosts)
         by_host = para.slurp(g_hosts, "/tmp/para.test", "para.test", opts)
         for host, result in by_host.items():
             if isinstance(result, para.Error):
                 raise result
             rc, _, _, path = result
             self.assertEqual(rc, 0)
-            self.assertTrue(path.endswith('%s/para.test' % (host)))
+            self.assertTrue(path.endswith(suffixes[host]))
+
+    def testChain(self):
+        opts = copy.copy(g_opts)
+        opts.localdir = self.tmpDir
+        steps = [('copy', "/etc/hosts", "/tmp/para.chain.test"),
+                 ('slurp', "/tmp/para.chain.test", "para.chain.test")]
+        suffixes = dict((h, h + '/para.chain.test') for h in g_hosts)
+        for host, results in para.chain(g_hosts, steps, opts).items():
+            for result in results:
+                if isinstance(result, para.Error):
+                    raise result
+            self.assertEqual(len(results), 2)
+            (rc1, _, _), (rc2, _, _, path) = results
+            self.assertEqual(rc1, 0)
+            self.assertEqual(rc2, 0)
+            self.assertTrue(path.endswith(suffixes[host]))
 
 if __name__ == '__main__':
+    # Set up before any test processes are forked, so that they share
+    # the control directory.
+    setup_tests()
+    loader = unittest.TestLoader()
     suite = unittest.TestSuite()
-    suite.addTest(unittest.makeSuite(CallTest, "test"))
-    suite.addTest(unittest.makeSuite(CopySlurpTest, "test"))
+    suite.addTest(loader.loadTestsFromTestCase(CallTest))
+    suite.addTest(loader.loadTestsFromTestCase(CopySlurpTest))
+    # Run the tests in parallel processes if concurrencytest is
+    # installed. Each test waits on the network, not on the CPU.
+    try:
+        from concurrencytest import ConcurrentTestSuite, fork_for_tests
+        suite = ConcurrentTestSuite(suite, fork_for_tests(suite.countTestCases()))
+    except ImportError:
+        pass
     result = unittest.TextTestRunner().run(suite)
     if not result.wasSuccessful():
         sys.exit(1)
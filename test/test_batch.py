@@ -0,0 +1,52 @@
+#!/usr/bin/python
+
+# Tests of splitting call_batch output, which need no TEST_HOSTS.
+
+import os
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, basedir)
+
+from parallax import _CallBatchOutputBuilder
+
+SEP = '__PARALLAX_SEP_0123456789abcdef__'
+
+
+class SplitTest(unittest.TestCase):
+    def setUp(self):
+        self.builder = _CallBatchOutputBuilder(3, SEP)
+
+    def testStdout(self):
+        buf = (b'a\nb\n\n' + SEP.encode() + b' 0\n' +
+               b'\n' + SEP.encode() + b' 1\n' +
+               b'no newline\n' + SEP.encode() + b' 127\n')
+        self.assertEqual(self.builder._split(buf, True),
+                         [(0, b'a\nb\n'), (1, b''), (127, b'no newline')])
+
+    def testStderr(self):
+        buf = (b'\n' + SEP.encode() + b'\n' +
+               b'oops\n\n' + SEP.encode() + b'\n')
+        self.assertEqual(self.builder._split(buf, False),
+                         [(None, b''), (None, b'oops\n')])
+
+    def testSeparatorLookalikeIsOutput(self):
+        buf = (b'x ' + SEP.encode() + b' 0\n' +
+               b'\n' + SEP.encode() + b' 0\n')
+        self.assertEqual(self.builder._split(buf, True),
+                         [(0, b'x ' + SEP.encode() + b' 0\n')])
+
+    def testIncompleteOutput(self):
+        buf = (b'a\n\n' + SEP.encode() + b' 0\n' +
+               b'b\n\n' + SEP.encode() + b' 1')
+        self.assertEqual(self.builder._split(buf, True), [(0, b'a\n')])
+        self.assertEqual(self.builder._split(b'partial', True), [])
+
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = loader.loadTestsFromTestCase(SplitTest)
+    result = unittest.TextTestRunner().run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
@@ -0,0 +1,53 @@
+#!/usr/bin/python
+
+# Tests of chain with call steps on the local host, which need no
+# TEST_HOSTS.
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, basedir)
+
+import parallax as para
+
+
+class ChainTest(unittest.TestCase):
+    def setUp(self):
+        self.host = socket.gethostname()
+        self.opts = para.Options(multiplex=False)
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testStepsRunInOrder(self):
+        steps = [('call', 'echo one'), ('call', 'echo two')]
+        results = para.chain([self.host], steps, self.opts)
+        self.assertEqual(results,
+                         {self.host: [(0, b'one\n', None), (0, b'two\n', None)]})
+
+    def testFailedStepEndsChain(self):
+        marker = os.path.join(self.tmpDir, 'third')
+        steps = [('call', 'echo one'), ('call', 'false'),
+                 ('call', 'touch %s' % marker)]
+        results = para.chain([self.host], steps, self.opts)[self.host]
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[0], (0, b'one\n', None))
+        self.assertTrue(isinstance(results[1], para.Error))
+        self.assertFalse(os.path.exists(marker))
+
+    def testNoSteps(self):
+        self.assertEqual(para.chain([self.host], [], self.opts), {})
+
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = loader.loadTestsFromTestCase(ChainTest)
+    result = unittest.TextTestRunner().run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
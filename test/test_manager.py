@@ -0,0 +1,83 @@
+#!/usr/bin/python
+
+# Tests of the Manager that run local processes only, and so need no
+# TEST_HOSTS.
+
+import os
+import signal
+import sys
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, basedir)
+
+from parallax.callbacks import DefaultCallbacks
+from parallax.manager import Manager, REACTORS
+from parallax.task import Task
+
+
+class QuietCallbacks(DefaultCallbacks):
+    def finished(self, task, n):
+        pass
+
+
+def count_polls(manager):
+    """Makes manager count the calls to its IOMap's poll method."""
+    polls = [0]
+    poll = manager.iomap.poll
+
+    def counting_poll(timeout=None):
+        polls[0] += 1
+        return poll(timeout)
+    manager.iomap.poll = counting_poll
+    return polls
+
+
+class ManagerTest(unittest.TestCase):
+    def testThrottledTasksDoNotSpin(self):
+        # With the running limit reached, queued tasks wait for a running
+        # task to finish rather than for a connection token.
+        for reactor in REACTORS:
+            manager = Manager(limit=2, timeout=0, reactor=reactor,
+                              connect_rate=50, callbacks=QuietCallbacks())
+            for _ in range(6):
+                manager.add_task(Task('localhost', None, None,
+                                      ['sleep', '0.5']))
+            polls = count_polls(manager)
+            self.assertEqual(manager.run(), [0] * 6)
+            self.assertTrue(polls[0] < 100, (reactor, polls[0]))
+
+    def testClosingIterationReapsTasks(self):
+        for reactor in REACTORS:
+            manager = Manager(limit=3, timeout=0, reactor=reactor,
+                              callbacks=QuietCallbacks())
+            tasks = [Task('localhost', None, None, ['true'])]
+            for _ in range(2):
+                tasks.append(Task('localhost', None, None, ['sleep', '10']))
+            for task in tasks:
+                manager.add_task(task)
+            finished = manager.iter_finished()
+            self.assertTrue(next(finished) is tasks[0])
+            finished.close()
+            for task in tasks[1:]:
+                self.assertFalse(task.pipes_open())
+                self.assertTrue(task.proc is None)
+                self.assertEqual(task.exitstatus, -signal.SIGKILL)
+
+    def testRunClosesEpoll(self):
+        manager = Manager(limit=2, timeout=0, reactor='epoll',
+                          callbacks=QuietCallbacks())
+        for expected in ([0], [0, 0]):
+            manager.add_task(Task('localhost', None, None, ['true']))
+            self.assertEqual(manager.run(), expected)
+            self.assertTrue(manager.iomap.closed)
+            epoll = getattr(manager.iomap, '_epoll', None)
+            if epoll is not None:
+                self.assertTrue(epoll.closed)
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = loader.loadTestsFromTestCase(ManagerTest)
+    result = unittest.TextTestRunner().run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)
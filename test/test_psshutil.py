@@ -0,0 +1,123 @@
+#!/usr/bin/python
+
+# Tests of the psshutil helpers, which need no TEST_HOSTS.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+basedir, bin = os.path.split(os.path.dirname(os.path.abspath(sys.argv[0])))
+sys.path.insert(0, basedir)
+
+from parallax import psshutil
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.monotonic = psshutil.monotonic
+        psshutil.monotonic = self.clock
+
+    def tearDown(self):
+        psshutil.monotonic = self.monotonic
+
+    def testBurst(self):
+        bucket = psshutil.TokenBucket(10, 3)
+        for _ in range(3):
+            self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def testRefill(self):
+        bucket = psshutil.TokenBucket(4, 1)
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+        self.assertEqual(bucket.delay(), 0.25)
+        self.clock.now += 0.125
+        self.assertEqual(bucket.delay(), 0.125)
+        self.assertFalse(bucket.try_acquire())
+        self.clock.now += 0.125
+        self.assertEqual(bucket.delay(), 0)
+        self.assertTrue(bucket.try_acquire())
+
+    def testRefillIsCappedAtBurst(self):
+        bucket = psshutil.TokenBucket(10, 2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.clock.now += 60
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+    def testBurstDefaultsToRate(self):
+        bucket = psshutil.TokenBucket(2)
+        self.assertTrue(bucket.try_acquire())
+        self.assertTrue(bucket.try_acquire())
+        self.assertFalse(bucket.try_acquire())
+
+
+class MakedirsParallelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.threads = [0]
+        self.thread = psshutil.threading.Thread
+        threads = self.threads
+        thread = self.thread
+
+        def counting_thread(*args, **kwargs):
+            threads[0] += 1
+            return thread(*args, **kwargs)
+        psshutil.threading.Thread = counting_thread
+
+    def tearDown(self):
+        psshutil.threading.Thread = self.thread
+        shutil.rmtree(self.tmpDir)
+
+    def paths(self, n):
+        return [os.path.join(self.tmpDir, 'd%d' % i) for i in range(n)]
+
+    def testFewDirectoriesAreCreatedSerially(self):
+        paths = self.paths(psshutil.PARALLEL_MKDIR_THRESHOLD - 1)
+        psshutil.makedirs_parallel(paths, 8)
+        self.assertEqual(self.threads[0], 0)
+        for path in paths:
+            self.assertTrue(os.path.isdir(path))
+
+    def testManyDirectoriesAreCreatedInParallel(self):
+        paths = self.paths(psshutil.PARALLEL_MKDIR_THRESHOLD * 2)
+        psshutil.makedirs_parallel(paths, 8)
+        self.assertEqual(self.threads[0], 8)
+        for path in paths:
+            self.assertTrue(os.path.isdir(path))
+
+    def testExistingDirectories(self):
+        paths = self.paths(psshutil.PARALLEL_MKDIR_THRESHOLD)
+        os.mkdir(paths[0])
+        psshutil.makedirs_parallel(paths, 8)
+        psshutil.makedirs_parallel(paths, 8)
+        for path in paths:
+            self.assertTrue(os.path.isdir(path))
+
+    def testErrorIsRaised(self):
+        paths = self.paths(psshutil.PARALLEL_MKDIR_THRESHOLD)
+        open(paths[-1], 'w').close()
+        self.assertRaises(OSError, psshutil.makedirs_parallel, paths, 8)
+
+
+if __name__ == '__main__':
+    loader = unittest.TestLoader()
+    suite = unittest.TestSuite()
+    suite.addTest(loader.loadTestsFromTestCase(TokenBucketTest))
+    suite.addTest(loader.loadTestsFromTestCase(MakedirsParallelTest))
+    result = unittest.TextTestRunner().run(suite)
+    if not result.wasSuccessful():
+        sys.exit(1)